@@ -9,12 +9,18 @@ Connects to Personal AI server via WebSocket and proxies commands to local HA.
 import asyncio
 import aiohttp
 import argparse
-import os
 import sys
 import json
 import logging
-from datetime import datetime
-from typing import Optional, Dict, Any
+import re
+from typing import Optional, Dict, Any, List, Set
+from yarl import URL
+
+try:
+    import orjson
+except ImportError:
+    # No orjson wheel on some arches (e.g. armhf); stdlib is slower but fine
+    orjson = None
 
 # Configure logging for HA addon
 logging.basicConfig(
@@ -24,15 +30,84 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-VERSION = "1.0.0"
+VERSION = "1.1.0"
+
+# Per-request timeout for HA REST calls. Not set on the session, where it
+# would also apply to the long-lived WebSocket connection.
+HA_TIMEOUT = aiohttp.ClientTimeout(total=15, connect=5)
+
+# Connection pool size for HA (all requests go to one host). Bulk reads
+# use at most half of it so service calls can still get a connection
+# before HA_TIMEOUT runs out.
+HA_MAX_CONNECTIONS = 16
+BULK_CONCURRENCY = HA_MAX_CONNECTIONS // 2
+BULK_MAX_ENTITIES = 500
+
+# /api/states bodies larger than this are parsed in a worker thread
+JSON_OFFLOAD_THRESHOLD = 64_000
+
+# Actions that don't change HA state, so they may run concurrently
+READ_ONLY_ACTIONS = frozenset({"get_entities", "get_state", "get_states_bulk"})
+
+# Max responses coalesced into a single "batch" frame, and its max size in
+# characters of encoded JSON; larger responses (e.g. big get_entities dumps)
+# are sent on their own
+SEND_BATCH_MAX = 32
+SEND_BATCH_MAX_SIZE = 256 << 10
+
+# Largest inbound WebSocket frame we accept
+WS_MAX_MSG_SIZE = 16 << 20
 
-# Safe domains
-SAFE_DOMAINS = {
+WS_TEXT = aiohttp.WSMsgType.TEXT
+WS_CLOSE_TYPES = frozenset({
+    aiohttp.WSMsgType.ERROR, aiohttp.WSMsgType.CLOSE,
+    aiohttp.WSMsgType.CLOSING, aiohttp.WSMsgType.CLOSED
+})
+
+# HA identifiers, checked before they're spliced into URL paths: yarl keeps
+# "/" and resolves "..", so an unchecked segment could escape its endpoint
+SLUG_RE = re.compile(r"[a-z0-9_]+")
+ENTITY_ID_RE = re.compile(r"[a-z0-9_]+\.[a-z0-9_]+")
+
+# Safe domains (immutable so nothing can widen the allowlist at runtime)
+SAFE_DOMAINS = frozenset({
     "light", "switch", "climate", "cover", "lock",
     "fan", "media_player", "scene", "vacuum", "input_boolean",
     "alarm_control_panel", "humidifier", "water_heater", "script",
     "automation", "input_select", "input_number", "input_text"
-}
+})
+
+
+if orjson is not None:
+    json_loads = orjson.loads
+    json_dumpb = orjson.dumps
+
+    def json_dumps(obj: Any) -> str:
+        return orjson.dumps(obj).decode()
+else:
+    json_loads = json.loads
+
+    def json_dumps(obj: Any) -> str:
+        return json.dumps(obj, separators=(",", ":"))
+
+    def json_dumpb(obj: Any) -> bytes:
+        return json_dumps(obj).encode()
+
+
+def group_entities(raw: bytes) -> Dict[str, List[Dict[str, Any]]]:
+    """Parse an /api/states body and group entities by domain"""
+    entities = {}
+    for entity in json_loads(raw):
+        entity_id = entity.get("entity_id") or ""
+        domain, sep, _ = entity_id.partition(".")
+        if not sep:
+            continue
+        entities.setdefault(domain, []).append({
+            "entity_id": entity_id,
+            "state": entity.get("state"),
+            "name": (entity.get("attributes") or {}).get("friendly_name", entity_id)
+        })
+    return entities
 
 
 class HomeAgent:
@@ -50,14 +125,50 @@ class HomeAgent:
         self.ha_token = ha_token
         self.reconnect_delay = reconnect_delay
         
+        # Swap only the scheme; the token is query-encoded by yarl
+        server = URL(self.server_url)
+        ws_scheme = {"https": "wss", "http": "ws"}.get(server.scheme, server.scheme)
+        self._ws_url = (
+            server.with_scheme(ws_scheme)
+            .with_path(server.path.rstrip("/") + "/api/v1/agent/ws")
+            .with_query(server.query)
+            .update_query(token=agent_token)
+        )
+        
+        # Parsed once; aiohttp takes URL objects as-is
+        self._api = URL(self.ha_url) / "api"
+        
+        # Built once; aiohttp doesn't mutate the headers we pass in
+        self._get_headers = {"Authorization": f"Bearer {ha_token}"}
+        self._post_headers = {**self._get_headers, "Content-Type": "application/json"}
+        
         self._ws: Optional[aiohttp.ClientWebSocketResponse] = None
         self._session: Optional[aiohttp.ClientSession] = None
         self._running = False
-        self._connected = False
+        self._batching = False
+        self._out_q: Optional[asyncio.Queue] = None
+        self._cmd_q: Optional[asyncio.Queue] = None
+        self._tasks: Set[asyncio.Task] = set()
+        self._bulk_slots = asyncio.Semaphore(BULK_CONCURRENCY)
+        
+        # Inbound message type -> handler
+        self._dispatch = {
+            "pong": self._noop,
+            "ha_command": self._on_ha_command,
+        }
     
     async def start(self):
         self._running = True
-        self._session = aiohttp.ClientSession()
+        # Keep-alive pool with DNS cache so HA requests reuse warm sockets
+        self._session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=0,
+                limit_per_host=HA_MAX_CONNECTIONS,
+                ttl_dns_cache=300,
+                keepalive_timeout=75,
+                enable_cleanup_closed=True
+            )
+        )
         
         logger.info("=" * 40)
         logger.info("Personal AI Agent v%s", VERSION)
@@ -95,11 +206,11 @@ class HomeAgent:
         try:
             async with self._session.get(
                 f"{self.ha_url}/api/",
-                headers={"Authorization": f"Bearer {self.ha_token}"},
+                headers=self._get_headers,
                 timeout=aiohttp.ClientTimeout(total=10)
             ) as resp:
                 if resp.status == 200:
-                    data = await resp.json()
+                    data = await resp.json(loads=json_loads)
                     logger.info("✓ Home Assistant %s", data.get('version', 'connected'))
                     return True
                 logger.warning("HA returned status %d", resp.status)
@@ -109,40 +220,51 @@ class HomeAgent:
             return False
     
     async def _connect(self):
-        ws_url = f"{self.server_url}/api/v1/agent/ws?token={self.agent_token}"
-        ws_url = ws_url.replace("https://", "wss://").replace("http://", "ws://")
-        
         logger.info("Connecting to Personal AI...")
         
         try:
+            # heartbeat sends protocol-level PING frames; no app ping needed
             self._ws = await self._session.ws_connect(
-                ws_url,
+                self._ws_url,
                 heartbeat=30,
-                receive_timeout=60
+                receive_timeout=60,
+                autoclose=True,  # answer CLOSE frames inside aiohttp
+                autoping=True,  # answer PINGs without surfacing them to us
+                compress=15,  # permessage-deflate; entity dumps compress well
+                max_msg_size=WS_MAX_MSG_SIZE
             )
             
             # Handshake
             await self._ws.send_json({
                 "type": "handshake",
                 "agent_version": VERSION,
-                "ha_url": "local"  # Don't expose internal URL
-            })
+                "ha_url": "local",  # Don't expose internal URL
+                "batch": True  # We can send responses as "batch" frames
+            }, dumps=json_dumps)
             
-            msg = await self._ws.receive_json()
+            msg = await self._ws.receive_json(loads=json_loads)
             if msg.get("type") == "welcome":
                 logger.info("✓ Connected to Personal AI!")
-                self._connected = True
+                # Only batch if the server acknowledged it can unpack them
+                self._batching = bool(msg.get("batch"))
             else:
                 logger.error("Unexpected response: %s", msg)
                 return
             
-            ping_task = asyncio.create_task(self._ping_loop())
+            self._out_q = asyncio.Queue()
+            self._cmd_q = asyncio.Queue()
+            send_task = asyncio.create_task(self._send_loop())
+            command_task = asyncio.create_task(self._command_loop())
             
             try:
                 await self._message_loop()
             finally:
-                ping_task.cancel()
-                self._connected = False
+                send_task.cancel()
+                command_task.cancel()
+                for task in list(self._tasks):
+                    task.cancel()
+                if not self._ws.closed:
+                    await self._ws.close()
                 
         except aiohttp.WSServerHandshakeError as e:
             logger.error("Connection rejected: %s", e)
@@ -151,44 +273,120 @@ class HomeAgent:
         except Exception as e:
             logger.error("WebSocket error: %s", e)
     
-    async def _ping_loop(self):
-        while self._connected:
+    def _encode_response(self, response: Dict[str, Any]) -> str:
+        try:
+            return json_dumps(response)
+        except (TypeError, ValueError) as e:
+            # Only this response is lost; reply with an error in its place
+            logger.error("Cannot encode response: %s", e)
+            return json_dumps({
+                "type": "ha_response",
+                "request_id": response.get("request_id"),
+                "result": {"success": False, "error": f"Unencodable result: {e}"}
+            })
+    
+    async def _send_loop(self):
+        encode = self._encode_response
+        pending = None  # Frame that didn't fit the previous batch
+        while True:
+            frame = pending or encode(await self._out_q.get())
+            pending = None
+            frames, size = [frame], len(frame)
+            while self._batching and len(frames) < SEND_BATCH_MAX and size < SEND_BATCH_MAX_SIZE:
+                try:
+                    frame = encode(self._out_q.get_nowait())
+                except asyncio.QueueEmpty:
+                    break
+                if size + len(frame) > SEND_BATCH_MAX_SIZE:
+                    pending = frame
+                    break
+                frames.append(frame)
+                size += len(frame)
+            
             try:
-                await self._ws.send_json({"type": "ping"})
-                await asyncio.sleep(30)
-            except:
+                if len(frames) == 1:
+                    await self._ws.send_str(frames[0])
+                else:
+                    # Frames are already encoded; splice them instead of re-encoding
+                    await self._ws.send_str('{"type":"batch","messages":[' + ",".join(frames) + "]}")
+            except Exception as e:
+                logger.error("Send failed: %s", e)
+                # Closing ends _message_loop, so _connect tears down and reconnects
+                await self._ws.close()
                 break
     
     async def _message_loop(self):
-        async for msg in self._ws:
-            if msg.type == aiohttp.WSMsgType.TEXT:
+        # Bind per-message lookups to locals once
+        receive, handle = self._ws.receive, self._handle_message
+        loads = json_loads
+        text, close_types = WS_TEXT, WS_CLOSE_TYPES
+        while True:
+            msg = await receive()
+            t = msg.type
+            if t is text:
                 try:
-                    data = json.loads(msg.data)
-                    await self._handle_message(data)
-                except json.JSONDecodeError:
-                    pass
-            elif msg.type in (aiohttp.WSMsgType.ERROR, aiohttp.WSMsgType.CLOSE, aiohttp.WSMsgType.CLOSED):
+                    data = loads(msg.data)
+                except ValueError:
+                    continue
+                await handle(data)
+            elif t in close_types:
                 break
     
     async def _handle_message(self, data: Dict[str, Any]):
-        msg_type = data.get("type")
+        if not isinstance(data, dict):
+            return
+        handler = self._dispatch.get(data.get("type"))
+        if handler:
+            await handler(data)
+    
+    async def _noop(self, data: Dict[str, Any]):
+        pass
+    
+    async def _on_ha_command(self, data: Dict[str, Any]):
+        # Queue instead of awaiting so the reader never waits on HA
+        self._cmd_q.put_nowait(data)
+    
+    async def _command_loop(self):
+        """Run commands in arrival order; only back-to-back reads overlap"""
+        while True:
+            data = await self._cmd_q.get()
+            command = data.get("command")
+            if isinstance(command, dict) and command.get("action") in READ_ONLY_ACTIONS:
+                task = asyncio.create_task(self._run_ha_command(data))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+                continue
+            # Anything that may change HA state waits for earlier reads and
+            # finishes before later commands start
+            if self._tasks:
+                await asyncio.wait(list(self._tasks))
+            await self._run_ha_command(data)
+    
+    async def _run_ha_command(self, data: Dict[str, Any], _log=logger.info):
+        request_id = data.get("request_id")
+        command = data.get("command")
         
-        if msg_type == "pong":
-            pass
-        elif msg_type == "ha_command":
-            request_id = data.get("request_id")
-            command = data.get("command", {})
-            
-            logger.info("Command: %s", command.get('action', 'unknown'))
+        # Every request_id gets a reply, even for malformed commands
+        try:
+            if not isinstance(command, dict):
+                raise ValueError("command must be an object")
+            _log("Command: %s", command.get('action', 'unknown'))
             result = await self._execute_ha_command(command)
-            
-            await self._ws.send_json({
-                "type": "ha_response",
-                "request_id": request_id,
-                "result": result
-            })
+        except Exception as e:
+            logger.error("Command error: %s", e)
+            result = {"success": False, "error": str(e)}
+        
+        self._out_q.put_nowait({
+            "type": "ha_response",
+            "request_id": request_id,
+            "result": result
+        })
     
-    async def _execute_ha_command(self, command: Dict[str, Any]) -> Dict[str, Any]:
+    async def _execute_ha_command(
+        self,
+        command: Dict[str, Any],
+        _safe=SAFE_DOMAINS.__contains__  # bound at def time: no global lookup per call
+    ) -> Dict[str, Any]:
         action = command.get("action")
         
         try:
@@ -196,15 +394,15 @@ class HomeAgent:
                 return await self._get_all_entities()
             elif action == "get_state":
                 return await self._get_entity_state(command.get("entity_id"))
+            elif action == "get_states_bulk":
+                return await self._get_entity_states(command.get("entity_ids", []))
             elif action == "call_service":
                 domain = command.get("domain")
-                service = command.get("service")
-                
-                if domain not in SAFE_DOMAINS:
+                if not _safe(domain):
                     return {"success": False, "error": f"Domain '{domain}' not allowed"}
                 
                 return await self._call_service(
-                    domain, service,
+                    domain, command.get("service"),
                     command.get("entity_id"),
                     command.get("data", {})
                 )
@@ -217,55 +415,72 @@ class HomeAgent:
     async def _get_all_entities(self) -> Dict[str, Any]:
         try:
             async with self._session.get(
-                f"{self.ha_url}/api/states",
-                headers={"Authorization": f"Bearer {self.ha_token}"}
+                self._api / "states",
+                headers=self._get_headers,
+                timeout=HA_TIMEOUT
             ) as resp:
                 if resp.status == 200:
-                    states = await resp.json()
-                    entities = {}
-                    for entity in states:
-                        entity_id = entity.get("entity_id", "")
-                        if "." not in entity_id:
-                            continue
-                        domain = entity_id.split(".")[0]
-                        if domain not in entities:
-                            entities[domain] = []
-                        entities[domain].append({
-                            "entity_id": entity_id,
-                            "state": entity.get("state"),
-                            "name": entity.get("attributes", {}).get("friendly_name", entity_id)
-                        })
+                    raw = await resp.read()
+                    if len(raw) > JSON_OFFLOAD_THRESHOLD:
+                        # Big installs: parse off the loop so in-flight command tasks, the
+                        # reader and the WebSocket heartbeat keep running meanwhile
+                        entities = await asyncio.get_running_loop().run_in_executor(
+                            None, group_entities, raw
+                        )
+                    else:
+                        entities = group_entities(raw)
                     return {"success": True, "entities": entities}
                 return {"success": False, "error": f"HA returned {resp.status}"}
         except Exception as e:
             return {"success": False, "error": str(e)}
     
     async def _get_entity_state(self, entity_id: str) -> Dict[str, Any]:
+        if not isinstance(entity_id, str) or not ENTITY_ID_RE.fullmatch(entity_id):
+            return {"success": False, "error": f"Invalid entity_id: {entity_id!r}"}
         try:
             async with self._session.get(
-                f"{self.ha_url}/api/states/{entity_id}",
-                headers={"Authorization": f"Bearer {self.ha_token}"}
+                self._api / "states" / entity_id,
+                headers=self._get_headers,
+                timeout=HA_TIMEOUT
             ) as resp:
                 if resp.status == 200:
-                    return {"success": True, "state": await resp.json()}
+                    return {"success": True, "state": await resp.json(loads=json_loads)}
                 return {"success": False, "error": f"HA returned {resp.status}"}
         except Exception as e:
             return {"success": False, "error": str(e)}
     
+    async def _get_entity_states(self, entity_ids: List[str]) -> Dict[str, Any]:
+        # Ids become keys of the reply, which must stay JSON-encodable
+        if not isinstance(entity_ids, list) or not all(isinstance(eid, str) for eid in entity_ids):
+            return {"success": False, "error": "entity_ids must be a list of strings"}
+        if len(entity_ids) > BULK_MAX_ENTITIES:
+            return {"success": False, "error": f"At most {BULK_MAX_ENTITIES} entity_ids per request"}
+        
+        async def fetch(entity_id: str) -> Dict[str, Any]:
+            async with self._bulk_slots:
+                return await self._get_entity_state(entity_id)
+        
+        results = await asyncio.gather(*(fetch(eid) for eid in entity_ids))
+        return {"success": True, "states": dict(zip(entity_ids, results))}
+    
     async def _call_service(self, domain: str, service: str, entity_id: Optional[str], data: Dict) -> Dict[str, Any]:
+        for name, value in (("domain", domain), ("service", service)):
+            if not isinstance(value, str) or not SLUG_RE.fullmatch(value):
+                return {"success": False, "error": f"Invalid {name}: {value!r}"}
         try:
-            service_data = {}
-            if entity_id:
-                service_data["entity_id"] = entity_id
-            service_data.update(data)
+            # Common case (turn_on/toggle with just an entity) skips the dict
+            if not data and entity_id:
+                body = b'{"entity_id":' + json_dumpb(entity_id) + b'}'
+            elif not data:
+                body = b'{}'
+            else:
+                body = json_dumpb({"entity_id": entity_id, **data} if entity_id else data)
             
             async with self._session.post(
-                f"{self.ha_url}/api/services/{domain}/{service}",
-                headers={
-                    "Authorization": f"Bearer {self.ha_token}",
-                    "Content-Type": "application/json"
-                },
-                json=service_data
+                self._api / "services" / domain / service,
+                headers=self._post_headers,
+                timeout=HA_TIMEOUT,
+                data=body
             ) as resp:
                 if resp.status == 200:
                     return {"success": True, "message": f"Called {domain}.{service}"}
@@ -297,4 +512,9 @@ async def main():
 
 
 if __name__ == "__main__":
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        pass
     asyncio.run(main())